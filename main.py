@@ -1,7 +1,18 @@
 import os
+import io
+import re
+import sys
+import json
+import time
+import zlib
+import gzip
+import hashlib
+import signal
+import functools
+import subprocess
 import aiohttp
 from dotenv import load_dotenv
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from openai import OpenAI
 from bs4 import BeautifulSoup
@@ -11,27 +22,38 @@ import openai
 import base64
 import mimetypes
 from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait
 import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import create_engine, event, delete, func, or_, Column, Integer, Float, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base, scoped_session
 from sqlalchemy.future import select # Используем select из sqlalchemy.future для совместимости
 import asyncio # Нужен для ожидания
+from concurrent.futures import ThreadPoolExecutor
 import aiofiles
 
 single_document_filter = filters.document & ~filters.media_group
 single_photo_filter = filters.photo & ~filters.media_group
 
-# Вверху файла:
-user_states = {}
-
-# Словарь для буферизации медиа-групп: {media_group_id: {'messages': [msg1, msg2,...], 'timer_task': task_handle}}
-media_group_buffers = {}
-# Блокировка для безопасного доступа к буферу из разных обработчиков (на всякий случай)
-buffer_lock = asyncio.Lock()
-# Задержка в секундах перед обработкой группы (чтобы успели прийти все сообщения)
-MEDIA_GROUP_DELAY = 2.0
-# Telegram max length per message
+# Состояния диалогов (user_states) и буферы медиа-групп (media_group_buffers) хранятся в хранилище состояний,
+# см. create_state_store() ниже — так они переживают перезапуск и доступны всем процессам бота.
+
+# Сборка медиа-групп (см. MediaGroupAssembler): после последнего сообщения альбома ждём
+# MEDIA_GROUP_GAP_FACTOR типичных интервалов между его сообщениями, но не меньше MIN и не больше MAX секунд.
+# Пока интервал не измерен, ждём MEDIA_GROUP_MAX_DELAY
+MEDIA_GROUP_MIN_DELAY = float(os.getenv("MEDIA_GROUP_MIN_DELAY", "0.3"))
+MEDIA_GROUP_MAX_DELAY = float(os.getenv("MEDIA_GROUP_MAX_DELAY", "2.0"))
+MEDIA_GROUP_GAP_FACTOR = float(os.getenv("MEDIA_GROUP_GAP_FACTOR", "3.0"))
+# Альбом в Telegram содержит не больше 10 элементов — дальше ждать нечего
+MEDIA_GROUP_MAX_SIZE = 10
+# Узнавать размер альбома запросом get_media_group, чтобы начинать обработку, как только пришли все сообщения
+MEDIA_GROUP_PROBE = os.getenv("MEDIA_GROUP_PROBE", "1") == "1"
+# Telegram max length per message (в единицах UTF-16, как считает Telegram)
 MAX_LENGTH = 4096
+# Ответы длиннее этого порога (в символах) отправляются одним файлом .md/.txt вместо серии сообщений; 0 — никогда
+LONG_REPLY_DOCUMENT_THRESHOLD = int(os.getenv("LONG_REPLY_DOCUMENT_THRESHOLD", "12000"))
+# Пауза между частями ответа после того, как Telegram попросил подождать (FloodWait)
+REPLY_PART_INTERVAL = float(os.getenv("REPLY_PART_INTERVAL", "1.0"))
 
 # Загрузка переменных из .env
 load_dotenv()
@@ -45,6 +67,55 @@ GROQ_API = os.getenv("GROQ_API")
 GROK_API = os.getenv("GROK_API")
 GLM_API = os.getenv("GLM_API")
 
+# Хранилище состояний: "sqlite" (общий файл для всех процессов, переживает перезапуск) или "memory" (только этот процесс)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_URL = os.getenv("STATE_DB_URL", "sqlite:///gpt_bot_state.db")
+# Время жизни состояний в секундах: незавершённый /context или /gen и буфер медиа-группы
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "900"))
+MEDIA_GROUP_TTL = int(os.getenv("MEDIA_GROUP_TTL", "300"))
+STATE_PURGE_INTERVAL = int(os.getenv("STATE_PURGE_INTERVAL", "300"))
+# Генерация изображений (/gen): одновременных запросов к DALL·E на процесс, активных задач на пользователя,
+# лимит картинок на пользователя за окно (в секундах), максимум вариантов за раз
+IMAGE_GEN_CONCURRENCY = int(os.getenv("IMAGE_GEN_CONCURRENCY", "3"))
+IMAGE_GEN_USER_ACTIVE_LIMIT = int(os.getenv("IMAGE_GEN_USER_ACTIVE_LIMIT", "1"))
+IMAGE_GEN_QUOTA = int(os.getenv("IMAGE_GEN_QUOTA", "20"))
+IMAGE_GEN_QUOTA_WINDOW = int(os.getenv("IMAGE_GEN_QUOTA_WINDOW", "3600"))
+IMAGE_GEN_MAX_VARIANTS = int(os.getenv("IMAGE_GEN_MAX_VARIANTS", "4"))
+IMAGE_GEN_PROGRESS_INTERVAL = float(os.getenv("IMAGE_GEN_PROGRESS_INTERVAL", "5"))
+# Ссылки OpenAI на картинки живут около часа, поэтому кэш (prompt, size, quality) храним чуть меньше
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", "3000"))
+IMAGE_SIZES = ["1024x1024", "1792x1024", "1024x1792"]
+IMAGE_QUALITIES = ["standard", "hd"]
+# История для модели: не меньше HISTORY_WINDOW последних сообщений; начало окна сдвигается шагами по HISTORY_STEP,
+# чтобы префикс запроса оставался одинаковым между ходами и срабатывало кэширование промпта у провайдеров
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "20"))
+HISTORY_STEP = int(os.getenv("HISTORY_STEP", "20"))
+# Хранение истории: значения по умолчанию для всех чатов (0 — без ограничения), переопределяются командой /retention
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_TURNS = int(os.getenv("RETENTION_MAX_TURNS", "0"))
+RETENTION_MAX_BYTES = int(os.getenv("RETENTION_MAX_BYTES", "0"))
+# Устаревшие сообщения перед удалением дописываются в ARCHIVE_DIR/<chat_id>.jsonl.gz
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Фоновое обслуживание БД: период, размер пачки удаления, пауза между пачками,
+# сколько секунд без запросов считается затишьем и сколько страниц освобождать за шаг incremental_vacuum
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+MAINTENANCE_PAUSE = float(os.getenv("MAINTENANCE_PAUSE", "0.5"))
+MAINTENANCE_IDLE_SECONDS = float(os.getenv("MAINTENANCE_IDLE_SECONDS", "2"))
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "1000"))
+# Шардирование чатов между процессами бота: номер этого процесса и их общее число
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+# Число процессов-воркеров. При BOT_WORKERS > 1 main.py запускается как супервизор и сам порождает воркеров
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Проверка здоровья воркеров: как часто воркер отмечается в хранилище состояний и через сколько секунд без отметки он перезапускается
+WORKER_HEARTBEAT_INTERVAL = int(os.getenv("WORKER_HEARTBEAT_INTERVAL", "10"))
+WORKER_HEALTH_TIMEOUT = int(os.getenv("WORKER_HEALTH_TIMEOUT", "60"))
+# Максимальная пауза перед перезапуском упавшего воркера (растёт экспоненциально при повторных падениях)
+WORKER_RESTART_MAX_DELAY = int(os.getenv("WORKER_RESTART_MAX_DELAY", "60"))
+# Потоков для запросов к моделям и DALL·E (отдельно от общего пула asyncio, которым пользуются хранилище и обслуживание БД)
+MODEL_CALL_THREADS = int(os.getenv("MODEL_CALL_THREADS", "32"))
+
 # Файлы и переменные
 MODEL_CATEGORIES = {
     "openai": {
@@ -110,7 +181,9 @@ GROK_MODELS = ["grok-4-0709"]
 GLM_MODELS = ["GLM-4.5-Air", "GLM-4.5-X", "GLM-4.5"]
 
 # Настройка клиентов
-client = Client("GPTBot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# У каждого воркера своя сессия Pyrogram; при одном процессе имя сессии прежнее
+SESSION_NAME = "GPTBot" if WORKER_COUNT == 1 else f"GPTBot_worker{WORKER_ID}"
+client = Client(SESSION_NAME, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 openai.api_key = OPENAI_API_KEY
 client_ai = OpenAI()
 client_deepseek = OpenAI(
@@ -137,18 +210,34 @@ client_glm = OpenAI(
     base_url = "https://api.z.ai/api/paas/v4",
     api_key=GLM_API
 )
-state = {"client_now":client_ai}
-
-# Функция для обработки собранной медиа-группы
-async def process_media_group(media_group_id: str, chat_id: str, client_instance):
-    async with buffer_lock:
-        if media_group_id not in media_group_buffers:
-            return # Группа уже обработана или произошла ошибка
 
-        grouped_messages = media_group_buffers[media_group_id]['messages']
-        # Убираем группу из буфера сразу, чтобы избежать повторной обработки
-        del media_group_buffers[media_group_id]
+# Запросы к API моделей длятся до нескольких минут. Они идут в собственном пуле потоков:
+# занятые ими потоки не должны мешать хранилищу состояний и heartbeat воркера
+model_call_executor = ThreadPoolExecutor(max_workers=MODEL_CALL_THREADS, thread_name_prefix="model-call")
+
+async def run_model_call(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(model_call_executor, functools.partial(func, *args, **kwargs))
+
+# Клиент API выбирается по модели чата, а не хранится глобально: так выбор переживает перезапуск
+# и не смешивается между чатами и процессами
+def client_for_model(model_name: str):
+    if model_name in GOOGLE_MODELS:
+        return client_google
+    if model_name in DEEPSEEK_MODELS:
+        return client_deepseek
+    if model_name in GROQ_MODELS:
+        return client_groq
+    if model_name in GROK_MODELS:
+        return client_grok
+    if model_name in GLM_MODELS:
+        return client_glm
+    return client_ai
 
+# Функция для обработки собранной медиа-группы
+async def process_media_group(entry: dict, cached_messages: list, client_instance):
+    chat_id = entry['chat_id']
+    grouped_messages = await load_media_group_messages(client_instance, entry, cached_messages)
     if not grouped_messages:
         return
 
@@ -261,47 +350,180 @@ async def process_media_group(media_group_id: str, chat_id: str, client_instance
         await process_message(message_to_reply, combined_content)
 
 
+# Сборщик медиа-групп: одна фоновая задача (sweeper) обрабатывает группы по их дедлайнам
+# вместо отдельного таймера на каждое сообщение. У каждой группы своя блокировка.
+# В хранилище состояний лежат только id сообщений группы. Ключ — "<media_group_id>:<id первого сообщения>",
+# чтобы опоздавшее сообщение, собранное в новую группу, не затёрло запись группы, которая уже ушла в обработку:
+# {buffer_key: {'chat_id': ..., 'media_group_id': ..., 'message_ids': [...]}}. Объекты сообщений и дедлайны — локально в процессе
+class MediaGroupAssembler:
+    def __init__(self):
+        # {media_group_id: {'chat_id', 'buffer_key', 'message_ids', 'messages', 'lock', 'deadline', 'last_at', 'expected', 'closed', 'client'}}
+        self.groups = {}
+        self.gap_estimate = None # сглаженный интервал между сообщениями одного альбома, секунды
+        self._wakeup = asyncio.Event()
+        self._sweeper = None
+        self._tasks = set() # ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+
+    # Сколько ждать после последнего сообщения группы
+    def current_delay(self) -> float:
+        if self.gap_estimate is None:
+            return MEDIA_GROUP_MAX_DELAY
+        return min(MEDIA_GROUP_MAX_DELAY, max(MEDIA_GROUP_MIN_DELAY, self.gap_estimate * MEDIA_GROUP_GAP_FACTOR))
+
+    def _learn_gap(self, gap: float):
+        # Интервалы длиннее максимального ожидания не относятся к одной пачке и только исказили бы оценку
+        if gap > MEDIA_GROUP_MAX_DELAY:
+            return
+        self.gap_estimate = gap if self.gap_estimate is None else 0.8 * self.gap_estimate + 0.2 * gap
+
+    def _run_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _schedule(self, group: dict, deadline: float):
+        group['deadline'] = deadline
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep())
+        self._wakeup.set()
+
+    # Дедлайн после очередного сообщения. Если размер альбома известен, а пришли ещё не все сообщения,
+    # ждём не меньше MEDIA_GROUP_MAX_DELAY: короткий выученный интервал не должен разрезать альбом на два запроса
+    def _reschedule(self, group: dict):
+        expected = group['expected'] or MEDIA_GROUP_MAX_SIZE
+        if len(group['message_ids']) >= expected:
+            # Все ожидаемые сообщения пришли — обрабатываем сразу, не дожидаясь дедлайна
+            self._schedule(group, 0.0)
+        elif group['expected']:
+            self._schedule(group, group['last_at'] + MEDIA_GROUP_MAX_DELAY)
+        else:
+            self._schedule(group, group['last_at'] + self.current_delay())
+
+    def _new_group(self, chat_id: str, client_instance, buffer_key: str, message_ids: list = None) -> dict:
+        # Настоящий дедлайн сразу: пока add() ждёт записи в хранилище, уже работающий сборщик не должен закрыть пустую группу
+        deadline = asyncio.get_running_loop().time() + self.current_delay()
+        return {
+            'chat_id': chat_id, 'buffer_key': buffer_key, 'message_ids': message_ids or [], 'messages': [],
+            'lock': asyncio.Lock(), 'deadline': deadline, 'last_at': None, 'expected': None, 'closed': False,
+            'client': client_instance
+        }
+
+    async def add(self, client_instance, message):
+        media_group_id = message.media_group_id
+        chat_id = str(message.chat.id)
+        now = asyncio.get_running_loop().time()
+
+        group = self.groups.get(media_group_id)
+        if group is None:
+            group = self._open_group(media_group_id, chat_id, client_instance, message.id)
+
+        async with group['lock']:
+            if group['closed']:
+                # Сообщение опоздало: группа уже ушла в обработку, собираем новую (как и раньше)
+                group = self._open_group(media_group_id, chat_id, client_instance, message.id)
+            if group['last_at'] is not None:
+                self._learn_gap(now - group['last_at'])
+            group['last_at'] = now
+            group['messages'].append(message)
+            group['message_ids'].append(message.id)
+            await media_group_buffers.set(group['buffer_key'], {
+                'chat_id': chat_id, 'media_group_id': media_group_id, 'message_ids': group['message_ids']
+            })
+            # Пока шла запись в хранилище, группу мог закрыть sweeper — тогда она уже в обработке
+            if not group['closed']:
+                self._reschedule(group)
+
+    def _open_group(self, media_group_id: str, chat_id: str, client_instance, first_message_id: int) -> dict:
+        group = self.groups[media_group_id] = self._new_group(chat_id, client_instance, f"{media_group_id}:{first_message_id}")
+        if MEDIA_GROUP_PROBE:
+            self._run_task(self._probe_size(group, first_message_id))
+        return group
+
+    # Узнаём, сколько сообщений в альбоме (сервер к этому моменту уже получил его целиком)
+    async def _probe_size(self, group: dict, message_id: int):
+        try:
+            members = await group['client'].get_media_group(int(group['chat_id']), message_id)
+        except Exception:
+            return # Не страшно: обойдёмся дедлайном
+        async with group['lock']:
+            if not group['closed']:
+                group['expected'] = len(members)
+                self._reschedule(group)
+
+    async def _sweep(self):
+        loop = asyncio.get_running_loop()
+        while self.groups:
+            self._wakeup.clear()
+            now = loop.time()
+            for media_group_id, group in list(self.groups.items()):
+                if group['deadline'] <= now:
+                    # Закрываем группу сразу, без ожидания: опоздавшее сообщение начнёт новую группу со своим ключом
+                    group['closed'] = True
+                    del self.groups[media_group_id]
+                    self._run_task(self._finalize(group))
+            if not self.groups:
+                break
+            timeout = min(group['deadline'] for group in self.groups.values()) - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _finalize(self, group: dict):
+        # Блокировка дожидается add(), который мог ещё дописывать эту группу в хранилище
+        async with group['lock']:
+            # Убираем группу из буфера сразу, чтобы избежать повторной обработки (в т.ч. другим процессом)
+            entry = await media_group_buffers.pop(group['buffer_key'])
+        if entry is None:
+            return # Группа уже обработана или произошла ошибка
+        await process_media_group(entry, group['messages'], group['client'])
+
+    # После перезапуска обрабатываем медиа-группы, которые остались в буфере
+    async def resume(self, client_instance):
+        for buffer_key, entry in await media_group_buffers.items():
+            # Ключ — buffer_key: восстановленная группа не смешивается с новыми сообщениями того же альбома
+            if owns_chat(entry['chat_id']) and buffer_key not in self.groups:
+                group = self.groups[buffer_key] = self._new_group(entry['chat_id'], client_instance, buffer_key, entry['message_ids'])
+                self._schedule(group, 0.0)
+
+media_group_assembler = MediaGroupAssembler()
+
 # Обработчик для сообщений, входящих в медиа-группу
 @client.on_message(filters.media_group)
 
 async def media_group_handler(c: Client, message: Message):
-    media_group_id = message.media_group_id
-    chat_id = str(message.chat.id)
+    await media_group_assembler.add(c, message)
 
-    async with buffer_lock:
-        # Если это первое сообщение группы
-        if media_group_id not in media_group_buffers:
-            media_group_buffers[media_group_id] = {'messages': [message], 'timer_task': None}
-            # Запускаем таймер на обработку
-            task = asyncio.create_task(
-                schedule_group_processing(media_group_id, chat_id, c)
-            )
-            media_group_buffers[media_group_id]['timer_task'] = task
-        else:
-            # Добавляем сообщение в существующую группу
-            media_group_buffers[media_group_id]['messages'].append(message)
-            # Перезапускаем таймер (отменяем старый, создаем новый)
-            if media_group_buffers[media_group_id]['timer_task']:
-                media_group_buffers[media_group_id]['timer_task'].cancel()
-            task = asyncio.create_task(
-                schedule_group_processing(media_group_id, chat_id, c)
-            )
-            media_group_buffers[media_group_id]['timer_task'] = task
+# Возвращает сообщения группы по порядку. Если процесс перезапускался, локальных объектов нет — догружаем из Telegram
+async def load_media_group_messages(client_instance, entry: dict, cached_messages: list):
+    message_ids = entry['message_ids']
+    cached_ids = {msg.id for msg in cached_messages}
+    if cached_messages and cached_ids.issuperset(message_ids):
+        return sorted(cached_messages, key=lambda msg: msg.id)
 
-# Вспомогательная функция для отложенного запуска
-async def schedule_group_processing(media_group_id: str, chat_id: str, client_instance):
-    await asyncio.sleep(MEDIA_GROUP_DELAY)
-    # Проверяем еще раз под блокировкой, существует ли группа (вдруг ее уже обработали или отменили)
-    async with buffer_lock:
-        if media_group_id in media_group_buffers:
-             # Запускаем основную обработку группы
-             asyncio.create_task(process_media_group(media_group_id, chat_id, client_instance))
+    fetched = await client_instance.get_messages(int(entry['chat_id']), message_ids)
+    return sorted((msg for msg in fetched if msg and not msg.empty), key=lambda msg: msg.id)
 
 # Настройка базы данных
+# SQLite-движок, которым могут одновременно пользоваться несколько процессов бота:
+# WAL не блокирует чтение на время записи, а запись ждёт занятую блокировку до 30 секунд
+def create_sqlite_engine(url: str):
+    sqlite_engine = create_engine(url, echo=False, connect_args={"timeout": 30}) # echo=True для отладки SQL запросов
+
+    @event.listens_for(sqlite_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL") # параллельное чтение из нескольких процессов
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return sqlite_engine
+
 DATABASE_URL = "sqlite:///gpt_bot_data.db" # Файл базы данных будет создан в той же папке
-engine = create_engine(DATABASE_URL, echo=False) # echo=True для отладки SQL запросов
+engine = create_sqlite_engine(DATABASE_URL)
 Base = declarative_base()
-SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+SessionFactory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = scoped_session(SessionFactory)
 
 # Определяем модели таблиц
 class Chat(Base):
@@ -322,9 +544,41 @@ class Message(Base):
     # Связь с чатом
     chat = relationship("Chat", back_populates="messages")
 
+# Настройки хранения истории для чата. None — значение по умолчанию из .env, 0 — без ограничения
+class ChatRetention(Base):
+    __tablename__ = "chat_retention"
+    chat_id = Column(String, ForeignKey("chats.chat_id"), primary_key=True)
+    max_age_days = Column(Integer, nullable=True)
+    max_turns = Column(Integer, nullable=True) # ход — пара сообщений пользователь + ассистент
+    max_bytes = Column(Integer, nullable=True)
+
+# Накопленная статистика запросов по моделям: токены (в т.ч. из кэша промпта провайдера) и время ответа
+class ModelUsage(Base):
+    __tablename__ = "model_usage"
+    model_name = Column(String, primary_key=True)
+    requests = Column(Integer, default=0)
+    cached_requests = Column(Integer, default=0) # запросы, где провайдер взял часть промпта из кэша
+    prompt_tokens = Column(Integer, default=0)
+    cached_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    latency_total = Column(Float, default=0.0) # секунды
+    cached_latency_total = Column(Float, default=0.0)
+
 # Создаем таблицы, если их нет
 Base.metadata.create_all(bind=engine)
 
+# Включает инкрементальный auto_vacuum, чтобы место от удалённых сообщений возвращалось файловой системе.
+# Для существующей базы режим применяется только после полного VACUUM, он выполняется один раз
+def enable_incremental_vacuum():
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2: # 2 — INCREMENTAL
+            conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+
+# Только в процессе-родителе: воркеры не должны одновременно запускать VACUUM
+if "WORKER_ID" not in os.environ:
+    enable_incremental_vacuum()
+
 # Функция для получения сессии базы данных (управляет сессиями)
 def get_db():
     db = SessionLocal()
@@ -334,6 +588,316 @@ def get_db():
         db.close()
 
 
+# Хранилище состояний (user_states, media_group_buffers)
+# Оба бэкенда хранят значения в JSON и поддерживают TTL, поэтому взаимозаменяемы
+class MemoryStateStore:
+    """Состояния в памяти текущего процесса. Не переживают перезапуск и не видны другим процессам."""
+
+    def __init__(self):
+        self._data = {} # {(namespace, key): (json_value, expires_at)}
+
+    def get(self, namespace: str, key: str, default=None):
+        item = self._data.get((namespace, key))
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.time():
+            del self._data[(namespace, key)]
+            return default
+        return json.loads(value)
+
+    def set(self, namespace: str, key: str, value, ttl: float = None):
+        expires_at = time.time() + ttl if ttl else None
+        self._data[(namespace, key)] = (json.dumps(value), expires_at)
+
+    def pop(self, namespace: str, key: str, default=None):
+        value = self.get(namespace, key, default)
+        self._data.pop((namespace, key), None)
+        return value
+
+    def items(self, namespace: str):
+        keys = [key for ns, key in self._data if ns == namespace]
+        return [(key, value) for key in keys if (value := self.get(namespace, key)) is not None]
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        expired = [k for k, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]
+        for k in expired:
+            del self._data[k]
+        return len(expired)
+
+
+StateBase = declarative_base()
+
+class StateEntry(StateBase):
+    __tablename__ = "state"
+    namespace = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(Text) # JSON
+    expires_at = Column(Float, nullable=True, index=True) # unix time, None — бессрочно
+
+
+class SqliteStateStore:
+    """Состояния в SQLite-файле. Один файл может использоваться несколькими процессами бота
+    (локальная замена общего хранилища вроде Redis)."""
+
+    def __init__(self, url: str):
+        self.engine = create_sqlite_engine(url)
+        StateBase.metadata.create_all(bind=self.engine)
+
+    @staticmethod
+    def _alive():
+        return or_(StateEntry.expires_at.is_(None), StateEntry.expires_at > time.time())
+
+    def get(self, namespace: str, key: str, default=None):
+        with self.engine.connect() as conn:
+            value = conn.execute(
+                select(StateEntry.value)
+                .filter(StateEntry.namespace == namespace, StateEntry.key == key, self._alive())
+            ).scalar_one_or_none()
+        return default if value is None else json.loads(value)
+
+    def set(self, namespace: str, key: str, value, ttl: float = None):
+        expires_at = time.time() + ttl if ttl else None
+        stmt = sqlite_insert(StateEntry).values(namespace=namespace, key=key, value=json.dumps(value), expires_at=expires_at)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[StateEntry.namespace, StateEntry.key],
+            set_={"value": stmt.excluded.value, "expires_at": stmt.excluded.expires_at}
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def pop(self, namespace: str, key: str, default=None):
+        with self.engine.begin() as conn:
+            value = conn.execute(
+                select(StateEntry.value)
+                .filter(StateEntry.namespace == namespace, StateEntry.key == key, self._alive())
+            ).scalar_one_or_none()
+            deleted = conn.execute(
+                delete(StateEntry).where(StateEntry.namespace == namespace, StateEntry.key == key)
+            ).rowcount
+        # Если запись успел удалить другой процесс, значение принадлежит ему
+        if value is None or deleted == 0:
+            return default
+        return json.loads(value)
+
+    def items(self, namespace: str):
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(StateEntry.key, StateEntry.value)
+                .filter(StateEntry.namespace == namespace, self._alive())
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def purge_expired(self) -> int:
+        with self.engine.begin() as conn:
+            return conn.execute(
+                delete(StateEntry).where(StateEntry.expires_at.is_not(None), StateEntry.expires_at <= time.time())
+            ).rowcount
+
+
+class StateNamespace:
+    """Доступ к одному пространству имён хранилища: await user_states.set(chat_id, "awaiting_prompt").
+    Обращения к хранилищу выполняются в отдельном потоке: SQLite может ждать блокировку,
+    занятую другим процессом, и не должен при этом останавливать цикл событий."""
+
+    def __init__(self, store, namespace: str, ttl: float = None):
+        self.store = store
+        self.namespace = namespace
+        self.ttl = ttl
+
+    async def get(self, key, default=None):
+        return await asyncio.to_thread(self.store.get, self.namespace, str(key), default)
+
+    # ttl — чтобы переопределить время жизни пространства имён для одной записи
+    async def set(self, key, value, ttl: float = None):
+        await asyncio.to_thread(self.store.set, self.namespace, str(key), value, ttl or self.ttl)
+
+    async def pop(self, key, default=None):
+        return await asyncio.to_thread(self.store.pop, self.namespace, str(key), default)
+
+    async def items(self):
+        return await asyncio.to_thread(self.store.items, self.namespace)
+
+
+def create_state_store():
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore()
+    if STATE_BACKEND == "sqlite":
+        return SqliteStateStore(STATE_DB_URL)
+    raise ValueError(f"Неизвестный STATE_BACKEND: {STATE_BACKEND}")
+
+
+state_store = create_state_store()
+user_states = StateNamespace(state_store, "user_states", ttl=USER_STATE_TTL)
+# Параметры /gen, ожидающие промпта: {chat_id: {'variants': 1, 'size': '1024x1024', 'quality': 'standard'}}
+gen_options = StateNamespace(state_store, "gen_options", ttl=USER_STATE_TTL)
+image_cache = StateNamespace(state_store, "image_cache", ttl=IMAGE_CACHE_TTL)
+image_quotas = StateNamespace(state_store, "image_quotas") # {user_id: {'count': ..., 'reset_at': ...}}
+media_group_buffers = StateNamespace(state_store, "media_groups", ttl=MEDIA_GROUP_TTL)
+
+
+# Детерминированный номер шарда (процесса) для чата: одинаков во всех процессах и после перезапуска
+def shard_for_chat(chat_id, shard_count: int = WORKER_COUNT) -> int:
+    return zlib.crc32(str(chat_id).encode("utf-8")) % shard_count
+
+def owns_chat(chat_id) -> bool:
+    return shard_for_chat(chat_id) == WORKER_ID
+
+
+# Обслуживание базы: хранение истории, архивация и возврат места
+# Время последнего запроса к модели; обслуживание старается не работать одновременно с живым трафиком
+bot_activity = {"last_request": 0.0}
+
+def get_retention_policy(db, chat_id: str) -> dict:
+    settings = db.get(ChatRetention, chat_id)
+    defaults = {"max_age_days": RETENTION_MAX_AGE_DAYS, "max_turns": RETENTION_MAX_TURNS, "max_bytes": RETENTION_MAX_BYTES}
+    if settings is None:
+        return defaults
+    return {key: default if getattr(settings, key) is None else getattr(settings, key) for key, default in defaults.items()}
+
+# Наибольший id сообщения, которое уже не укладывается в политику хранения (None — удалять нечего)
+def find_retention_cutoff(db, chat_id: str, policy: dict):
+    cutoffs = []
+    if policy["max_age_days"]:
+        border = datetime.datetime.utcnow() - datetime.timedelta(days=policy["max_age_days"])
+        cutoffs.append(db.execute(
+            select(func.max(Message.id)).filter(Message.chat_id == chat_id, Message.timestamp < border)
+        ).scalar())
+    if policy["max_turns"]:
+        cutoffs.append(db.execute(
+            select(Message.id).filter(Message.chat_id == chat_id)
+            .order_by(Message.id.desc()).offset(policy["max_turns"] * 2).limit(1)
+        ).scalar())
+    if policy["max_bytes"]:
+        # Размеры считает SQLite, в Python приходят только числа
+        rows = db.execute(
+            select(Message.id, func.length(Message.content)).filter(Message.chat_id == chat_id).order_by(Message.id.desc())
+        )
+        total = 0
+        for message_id, size in rows:
+            total += size or 0
+            if total > policy["max_bytes"]:
+                cutoffs.append(message_id)
+                break
+    cutoffs = [cutoff for cutoff in cutoffs if cutoff is not None]
+    return max(cutoffs) if cutoffs else None
+
+# Архивирует и удаляет одну пачку старейших сообщений до cutoff_id включительно; возвращает число удалённых
+def archive_and_delete_batch(chat_id: str, cutoff_id: int) -> int:
+    db = next(get_db())
+    try:
+        rows = db.execute(
+            select(Message.id, Message.role, Message.content, Message.timestamp)
+            .filter(Message.chat_id == chat_id, Message.id <= cutoff_id)
+            .order_by(Message.id).limit(MAINTENANCE_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            return 0
+
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        # gzip в режиме дозаписи добавляет новый member — файл остаётся читаемым целиком
+        with gzip.open(os.path.join(ARCHIVE_DIR, f"{chat_id}.jsonl.gz"), "at", encoding="utf-8") as f:
+            for message_id, role, content, timestamp in rows:
+                f.write(json.dumps({
+                    "id": message_id, "role": role, "content": content,
+                    "timestamp": timestamp.isoformat() if timestamp else None
+                }, ensure_ascii=False) + "\n")
+
+        db.execute(delete(Message).where(Message.chat_id == chat_id, Message.id <= rows[-1][0]))
+        db.commit()
+        return len(rows)
+    finally:
+        db.close()
+
+# Возвращает файловой системе до MAINTENANCE_VACUUM_PAGES свободных страниц; True — если свободные ещё остались
+def incremental_vacuum_step() -> bool:
+    connection = engine.raw_connection()
+    try:
+        # executescript выполняет PRAGMA до конца; обычный execute в sqlite3 освобождает лишь одну страницу
+        connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES});")
+        return connection.driver_connection.execute("PRAGMA freelist_count").fetchone()[0] > 0
+    finally:
+        connection.close()
+
+def retention_cutoffs() -> dict:
+    db = next(get_db())
+    try:
+        chat_ids = [row[0] for row in db.execute(select(Chat.chat_id))]
+        cutoffs = {}
+        for chat_id in chat_ids:
+            if not owns_chat(chat_id):
+                continue
+            policy = get_retention_policy(db, chat_id)
+            if any(policy.values()):
+                cutoff = find_retention_cutoff(db, chat_id, policy)
+                if cutoff is not None:
+                    cutoffs[chat_id] = cutoff
+        return cutoffs
+    finally:
+        db.close()
+
+# Ждём паузы в запросах к модели, но не дольше минуты, чтобы обслуживание не откладывалось вечно
+async def wait_for_quiet(max_wait: float = 60):
+    waited = 0.0
+    while time.time() - bot_activity["last_request"] < MAINTENANCE_IDLE_SECONDS and waited < max_wait:
+        await asyncio.sleep(MAINTENANCE_PAUSE)
+        waited += MAINTENANCE_PAUSE
+
+# Один проход обслуживания: работа идёт в отдельном потоке небольшими пачками с паузами между ними
+async def run_maintenance_pass():
+    cutoffs = await asyncio.to_thread(retention_cutoffs)
+    for chat_id, cutoff_id in cutoffs.items():
+        while True:
+            await wait_for_quiet()
+            if not await asyncio.to_thread(archive_and_delete_batch, chat_id, cutoff_id):
+                break
+            await asyncio.sleep(MAINTENANCE_PAUSE)
+
+    # Место возвращает только один процесс, чтобы воркеры не конкурировали за блокировку базы
+    if WORKER_ID == 0:
+        while True:
+            await wait_for_quiet()
+            if not await asyncio.to_thread(incremental_vacuum_step):
+                break
+            await asyncio.sleep(MAINTENANCE_PAUSE)
+
+async def database_maintenance():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await run_maintenance_pass()
+        except Exception as e:
+            print(f"⚠️ Ошибка обслуживания базы: {e}")
+
+
+# Воркер отмечается в общем хранилище, супервизор по этим отметкам проверяет, что он жив.
+# У heartbeat свой поток: даже если все остальные потоки заняты, отметка не встанет в очередь за ними
+heartbeat_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="heartbeat")
+
+async def worker_heartbeat():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(
+                heartbeat_executor, state_store.set, "workers", str(WORKER_ID),
+                {"pid": os.getpid(), "ts": time.time()}, WORKER_HEALTH_TIMEOUT * 2
+            )
+        except Exception as e:
+            print(f"⚠️ Воркер {WORKER_ID}: ошибка записи heartbeat: {e}")
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+
+# Периодически удаляем просроченные состояния
+async def purge_expired_states():
+    while True:
+        await asyncio.sleep(STATE_PURGE_INTERVAL)
+        try:
+            await asyncio.to_thread(state_store.purge_expired)
+        except Exception as e:
+            print(f"⚠️ Ошибка очистки состояний: {e}")
+
+
 
 def encode_image_as_base64(path: str):
     with open(path, "rb") as f:
@@ -342,6 +906,145 @@ def encode_image_as_base64(path: str):
     return f"data:{mime_type};base64,{encoded}"
 
 
+# Доставка длинных ответов
+CODE_FENCE = "```"
+
+# Длина текста так, как её считает Telegram (UTF-16: эмодзи и редкие символы занимают 2 единицы)
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+# Склеивает куски (каждый не длиннее limit) в как можно меньшее число частей не длиннее limit
+def _pack_pieces(pieces: list, limit: int) -> list:
+    parts, current = [], ""
+    for piece in pieces:
+        if current and utf16_len(current) + utf16_len(piece) > limit:
+            parts.append(current)
+            current = ""
+        current += piece
+    if current:
+        parts.append(current)
+    return parts
+
+# Режет текст без разметки: по строкам, затем по словам, и только в крайнем случае посимвольно
+def _split_plain(text: str, limit: int) -> list:
+    if utf16_len(text) <= limit:
+        return [text]
+    pieces = []
+    for line in text.splitlines(keepends=True):
+        if utf16_len(line) <= limit:
+            pieces.append(line)
+            continue
+        for word in re.findall(r"\S+\s*|\s+", line):
+            if utf16_len(word) <= limit:
+                pieces.append(word)
+                continue
+            chunk = ""
+            for char in word: # посимвольно, суррогатные пары при этом не разрываются
+                if utf16_len(chunk + char) > limit:
+                    pieces.append(chunk)
+                    chunk = ""
+                chunk += char
+            pieces.append(chunk)
+    return _pack_pieces(pieces, limit)
+
+# Делит текст на блоки: абзацы (до пустой строки) и целиком блоки кода ```...```
+def _split_blocks(text: str) -> list:
+    blocks, current, in_code = [], "", False
+    for line in text.splitlines(keepends=True):
+        is_fence = line.strip().startswith(CODE_FENCE)
+        if is_fence and not in_code and current:
+            blocks.append(current)
+            current = ""
+        current += line
+        if is_fence:
+            in_code = not in_code
+            if not in_code:
+                blocks.append(current)
+                current = ""
+        elif not in_code and not line.strip():
+            blocks.append(current)
+            current = ""
+    if current:
+        blocks.append(current)
+    return blocks
+
+# Режет слишком длинный блок кода так, чтобы каждая часть была отдельным корректным блоком ```...```
+def _split_code_block(block: str, limit: int) -> list:
+    lines = block.splitlines(keepends=True)
+    opening = lines[0] if lines[0].endswith("\n") else lines[0] + "\n"
+    body_lines = lines[1:]
+    if body_lines and body_lines[-1].strip().startswith(CODE_FENCE):
+        body_lines = body_lines[:-1]
+    body = "".join(body_lines)
+    if body and not body.endswith("\n"):
+        body += "\n"
+    closing = CODE_FENCE + "\n"
+    budget = limit - utf16_len(opening) - utf16_len(closing)
+    # Строка открытия блока (```язык ...) слишком длинная, чтобы повторять её в каждой части — режем как обычный текст
+    if budget < limit // 4:
+        return _split_plain(block, limit)
+    return [opening + piece + ("" if piece.endswith("\n") else "\n") + closing for piece in _split_plain(body, budget)]
+
+# Разбивает ответ на части для Telegram, не разрывая без необходимости абзацы, блоки кода и слова
+def split_message(text: str, limit: int = MAX_LENGTH) -> list:
+    pieces = []
+    for block in _split_blocks(text):
+        if utf16_len(block) <= limit:
+            pieces.append(block)
+        elif block.lstrip().startswith(CODE_FENCE):
+            pieces.extend(_split_code_block(block, limit))
+        else:
+            pieces.extend(_split_plain(block, limit))
+    parts = [part.strip("\n") for part in _pack_pieces(pieces, limit)]
+    return [part for part in parts if part.strip()]
+
+# Отправка с учётом FloodWait: Telegram сообщает, сколько секунд подождать
+async def send_with_flood_wait(send, *args, **kwargs):
+    while True:
+        try:
+            return await send(*args, **kwargs)
+        except FloodWait as e:
+            await asyncio.sleep(e.value + 1)
+
+async def send_long_reply(message: Message, text: str):
+    if LONG_REPLY_DOCUMENT_THRESHOLD and len(text) > LONG_REPLY_DOCUMENT_THRESHOLD:
+        # Разметка есть — отдаём .md, чтобы её было удобно читать
+        is_markdown = CODE_FENCE in text or re.search(r"^(#{1,6} |[-*] |\d+\. )", text, re.MULTILINE)
+        document = io.BytesIO(text.encode("utf-8"))
+        document.name = "answer.md" if is_markdown else "answer.txt"
+        await send_with_flood_wait(
+            message.reply_document,
+            document,
+            caption=f"📄 Ответ получился длинным ({len(text)} символов), отправляю файлом."
+        )
+        return
+
+    interval = 0.0
+    for i, part in enumerate(split_message(text)):
+        if i and interval:
+            await asyncio.sleep(interval)
+        try:
+            await message.reply_text(part)
+        except FloodWait as e:
+            # Telegram притормаживает — ждём и дальше шлём части с паузой
+            await asyncio.sleep(e.value + 1)
+            interval = REPLY_PART_INTERVAL
+            await send_with_flood_wait(message.reply_text, part)
+
+
+
+
+# Маршрутизация по шардам: каждый воркер получает все обновления, но обрабатывает только свои чаты.
+# Так все сообщения одного чата обрабатываются одним процессом и по порядку
+@client.on_message(group=-1)
+async def route_message_to_shard(_, message: Message):
+    if not owns_chat(message.chat.id):
+        message.stop_propagation()
+
+@client.on_callback_query(group=-1)
+async def route_callback_to_shard(_, query):
+    if query.message and not owns_chat(query.message.chat.id):
+        query.stop_propagation()
 
 
 # Команда /start
@@ -380,7 +1083,9 @@ async def update_commands(_, message: Message):
         BotCommand("gen", "Сгенерировать изображение DALL·E"),
         BotCommand("info", "Показать текущую модель и системный промпт"),
         BotCommand("help", "Показать справочное меню"),
-        BotCommand("reset_context", "Удалить системный промпт")
+        BotCommand("reset_context", "Удалить системный промпт"),
+        BotCommand("retention", "Настроить хранение истории"),
+        BotCommand("stats", "Статистика кэширования промпта по моделям")
     ]
     await client.set_bot_commands(commands)
     await message.reply_text("✅ Команды успешно обновлены!")
@@ -394,8 +1099,8 @@ async def forget(_, message: Message):
     try:
         chat = db.execute(select(Chat).filter(Chat.chat_id == chat_id)).scalar_one_or_none()
         if chat:
-            # Удаляем все сообщения для этого чата
-            db.query(Message).filter(Message.chat_id == chat_id).delete()
+            # Удаляем все сообщения для этого чата одним запросом
+            db.execute(delete(Message).where(Message.chat_id == chat_id))
             # Опционально: сбрасываем системный промпт, если нужно
             # chat.system_prompt = ""
             db.commit()
@@ -405,9 +1110,49 @@ async def forget(_, message: Message):
     finally:
         db.close()
 
+# Команда /retention — настройки хранения истории чата
+RETENTION_FIELDS = {"days": "max_age_days", "turns": "max_turns", "bytes": "max_bytes"}
+
+@client.on_message(filters.command("retention"))
+async def retention(_, message: Message):
+    chat_id = str(message.chat.id)
+    db = next(get_db())
+    try:
+        chat = db.execute(select(Chat).filter(Chat.chat_id == chat_id)).scalar_one_or_none()
+        if chat is None:
+            await message.reply_text("❗ Чат не зарегистрирован. Напиши /start.")
+            return
+
+        settings = db.get(ChatRetention, chat_id) or ChatRetention(chat_id=chat_id)
+        args = message.command[1:]
+        if args == ["reset"]:
+            settings.max_age_days = settings.max_turns = settings.max_bytes = None
+        for arg in (a for a in args if a != "reset"):
+            key, _, value = arg.partition("=")
+            if key not in RETENTION_FIELDS or not value.isdigit():
+                await message.reply_text("❗ Формат: <code>/retention days=30 turns=200 bytes=5000000</code> или <code>/retention reset</code>", parse_mode=ParseMode.HTML)
+                return
+            setattr(settings, RETENTION_FIELDS[key], int(value))
+        if args:
+            db.merge(settings)
+            db.commit()
+
+        policy = get_retention_policy(db, chat_id)
+        describe = lambda value, unit: f"{value} {unit}" if value else "без ограничения"
+        await message.reply_text(
+            f"🗄 <b>Хранение истории</b>\n\n"
+            f"Возраст: {describe(policy['max_age_days'], 'дн.')}\n"
+            f"Ходов: {describe(policy['max_turns'], '')}\n"
+            f"Объём: {describe(policy['max_bytes'], 'байт')}\n\n"
+            f"Устаревшие сообщения архивируются и удаляются в фоне.",
+            parse_mode=ParseMode.HTML
+        )
+    finally:
+        db.close()
+
 @client.on_message(filters.command("context"))
 async def ask_context(_, message: Message):
-    user_states[message.chat.id] = "awaiting_context"
+    await user_states.set(message.chat.id, "awaiting_context")
 
     cancel_button = InlineKeyboardMarkup([
         [InlineKeyboardButton("❌ Отменить", callback_data="cancel_context")]
@@ -497,19 +1242,6 @@ async def model_callback(_, query):
             await query.answer("Сначала зарегистрируй чат: /start", show_alert=True)
             return
 
-        if model_name in GOOGLE_MODELS:
-            state["client_now"] = client_google
-        elif model_name in DEEPSEEK_MODELS:
-            state["client_now"] = client_deepseek
-        elif model_name in GROQ_MODELS:
-            state["client_now"] = client_groq
-        elif model_name in GROK_MODELS:
-            state["client_now"] = client_grok
-        elif model_name in GLM_MODELS:
-            state["client_now"] = client_glm
-        else:
-            state["client_now"] = client_ai
-
         chat.model_name = model_name
         db.commit()
 
@@ -519,11 +1251,56 @@ async def model_callback(_, query):
         db.close()
 
 
+# Сборка истории для модели.
+# Провайдеры (OpenAI, DeepSeek, Gemini, Grok) кэшируют совпадающий префикс запроса, поэтому окно истории
+# не скользит на каждом сообщении: его начало сдвигается шагами по HISTORY_STEP, а между сдвигами
+# история только дописывается в конец
+def history_window_start(total: int) -> int:
+    return max(0, total - HISTORY_WINDOW) // HISTORY_STEP * HISTORY_STEP
+
+def load_history_window(db, chat_id: str) -> list:
+    total = db.execute(select(func.count(Message.id)).filter(Message.chat_id == chat_id)).scalar()
+    return db.execute(
+        select(Message.role, Message.content)
+        .filter(Message.chat_id == chat_id)
+        .order_by(Message.id) # id, а не timestamp: порядок строго совпадает с порядком сохранения
+        .offset(history_window_start(total))
+    ).fetchall()
+
+# Число токенов промпта, взятых из кэша провайдера. OpenAI, Grok, Gemini и GLM отдают его
+# в usage.prompt_tokens_details.cached_tokens, DeepSeek — в usage.prompt_cache_hit_tokens
+def cached_prompt_tokens(usage) -> int:
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return cached or 0
+
+def record_model_usage(db, model_name: str, usage, latency: float):
+    cached = cached_prompt_tokens(usage) if usage else 0
+    values = {
+        "requests": 1,
+        "cached_requests": 1 if cached else 0,
+        "prompt_tokens": getattr(usage, "prompt_tokens", None) or 0,
+        "cached_tokens": cached,
+        "completion_tokens": getattr(usage, "completion_tokens", None) or 0,
+        "latency_total": latency,
+        "cached_latency_total": latency if cached else 0.0,
+    }
+    stmt = sqlite_insert(ModelUsage).values(model_name=model_name, **values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ModelUsage.model_name],
+        set_={key: getattr(ModelUsage, key) + stmt.excluded[key] for key in values}
+    )
+    db.execute(stmt)
+
+
 # Автоответ на текст
 # Общая функция для обработки сообщений (текст, файл, картинка)
 async def process_message(message: Message, user_content: any):
     chat_id = str(message.chat.id)
-    db = next(get_db())
+    # Своя (не scoped) сессия: общую сессию потока во время await могут закрыть другие обработчики
+    db = SessionFactory()
     try:
         chat = db.execute(select(Chat).filter(Chat.chat_id == chat_id)).scalar_one_or_none()
         if chat is None:
@@ -531,38 +1308,37 @@ async def process_message(message: Message, user_content: any):
             # await message.reply_text("❗ Чат не зарегистрирован. Напиши /start.")
             return
 
-        
+        # Настройки чата читаем заранее: после await объект chat не используем
+        model_name = chat.model_name
+        system_prompt = chat.system_prompt
 
         # 2. Формируем историю для API
         history_for_api = []
         # Добавляем системный промпт, если он есть
-        if chat.system_prompt:
-            history_for_api.append({"role": "system", "content": chat.system_prompt})
+        if system_prompt:
+            history_for_api.append({"role": "system", "content": system_prompt})
 
-        # Получаем последние N сообщений из БД (например, 20)
-        # Важно ограничить историю, чтобы не превышать лимиты токенов API
+        # Добавляем историю из БД (старые -> новые) с устойчивым началом окна
         # Учитываем, что content хранится как JSON
-        db_messages = db.execute(
-            select(Message.role, Message.content)
-            .filter(Message.chat_id == chat_id)
-            .order_by(Message.timestamp.desc()) # Сначала новые
-            .limit(20) # Ограничиваем количество сообщений
-        ).fetchall()
-
-        # Добавляем сообщения в историю в правильном порядке (старые -> новые)
-        for role, content in reversed(db_messages): # Переворачиваем для правильного порядка
+        for role, content in load_history_window(db, chat_id):
              history_for_api.append({"role": role, "content": content})
 
         history_for_api.append({"role": "user", "content": user_content})
+        bot_activity["last_request"] = time.time()
         # 3. Отправляем запрос к OpenAI
         try:
-            client_now = state["client_now"]
-            resp = client_now.chat.completions.create(
-                model=chat.model_name, # Берем модель из настроек чата
+            client_now = client_for_model(model_name)
+            started_at = time.perf_counter()
+            # Запрос выполняем в отдельном потоке, чтобы не блокировать цикл событий (и проверку здоровья воркера)
+            resp = await run_model_call(
+                client_now.chat.completions.create,
+                model=model_name, # Берем модель из настроек чата
                 messages=history_for_api
             )
+            record_model_usage(db, model_name, resp.usage, time.perf_counter() - started_at)
             reply_content = resp.choices[0].message.content
             if not reply_content:
+                db.commit() # статистику сохраняем и для пустых ответов
                 raise ValueError("Эта модель не может ответить\nпопробуйте сменить модель /model \nили очистить историю /forget")
             # 4. Сохраняем ответ ассистента в БД
             # 1. Сохраняем сообщение пользователя в БД
@@ -571,13 +1347,8 @@ async def process_message(message: Message, user_content: any):
             db.add(Message(chat_id=chat_id, role="assistant", content=reply_content))
             db.commit()
 
-            # Разбиваем длинный ответ на части
-            if len(reply_content) <= MAX_LENGTH:
-                await message.reply_text(reply_content)
-            else:
-                parts = [reply_content[i:i+MAX_LENGTH] for i in range(0, len(reply_content), MAX_LENGTH)]
-                for i, part in enumerate(parts):
-                    await message.reply_text(part)
+            # Длинный ответ разбиваем на части или отправляем файлом
+            await send_long_reply(message, reply_content)
 
         except Exception as e:
             await message.reply_text(f"❌ Ошибка OpenAI: {e}")
@@ -587,12 +1358,180 @@ async def process_message(message: Message, user_content: any):
     finally:
         db.close()
 
+# Генерация изображений DALL·E: фоновые задачи с общим лимитом параллельных запросов,
+# квотами на пользователя и кэшем по (prompt, size, quality)
+image_gen_semaphore = asyncio.Semaphore(IMAGE_GEN_CONCURRENCY)
+image_jobs_active = {} # {user_id: число активных задач в этом процессе}
+image_quota_reserved = {} # {user_id: картинок зарезервировано запущенными, но ещё не списанными задачами}
+image_jobs = set() # ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+
+# Разбирает начальные аргументы /gen; 'consumed' — сколько аргументов оказались параметрами.
+# Число считается количеством вариантов только в пределах 1..IMAGE_GEN_MAX_VARIANTS, иначе это начало промпта ("/gen 1984 постер")
+def parse_gen_options(args: list) -> dict:
+    options = {"variants": 1, "size": IMAGE_SIZES[0], "quality": IMAGE_QUALITIES[0], "consumed": 0}
+    for arg in args:
+        value = arg.lower()
+        if value.isdigit() and 1 <= int(value) <= IMAGE_GEN_MAX_VARIANTS:
+            options["variants"] = int(value)
+        elif value in IMAGE_QUALITIES:
+            options["quality"] = value
+        elif value in IMAGE_SIZES:
+            options["size"] = value
+        else:
+            break
+        options["consumed"] += 1
+    return options
+
+def image_cache_key(prompt: str, size: str, quality: str) -> str:
+    return hashlib.sha256(f"{prompt}\n{size}\n{quality}".encode("utf-8")).hexdigest()
+
+# Картинки из кэша, ссылки на которые ещё живы. Срок отсчитывается от created_at каждой картинки,
+# а не от последней записи в кэш, поэтому дописывание новых вариантов не продлевает жизнь старых
+async def get_cached_images(cache_key: str) -> list:
+    now = time.time()
+    return [img for img in await image_cache.get(cache_key, []) if img.get("created_at", 0) + IMAGE_CACHE_TTL > now]
+
+async def add_cached_images(cache_key: str, images: list):
+    # Запись живёт столько же, сколько самая свежая картинка в ней
+    await image_cache.set(cache_key, await get_cached_images(cache_key) + images)
+
+# Сколько картинок пользователь ещё может сгенерировать в текущем окне квоты
+async def image_quota_left(user_id) -> int:
+    quota = await image_quotas.get(user_id)
+    return IMAGE_GEN_QUOTA - (quota["count"] if quota else 0)
+
+# Окно квоты отсчитывается от первой генерации, запись истекает вместе с окном
+async def consume_image_quota(user_id, count: int):
+    quota = await image_quotas.get(user_id) or {"count": 0, "reset_at": time.time() + IMAGE_GEN_QUOTA_WINDOW}
+    quota["count"] += count
+    await image_quotas.set(user_id, quota, ttl=max(1, quota["reset_at"] - time.time()))
+
+# Освобождает слот задачи пользователя и остаток зарезервированной квоты
+def release_image_job(user_id, reserved: int):
+    image_jobs_active[user_id] -= 1
+    if not image_jobs_active[user_id]:
+        del image_jobs_active[user_id]
+    image_quota_reserved[user_id] -= reserved
+    if not image_quota_reserved[user_id]:
+        del image_quota_reserved[user_id]
+
+async def start_image_job(message: Message, prompt: str, options: dict):
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    variants = options["variants"]
+
+    if image_jobs_active.get(user_id, 0) >= IMAGE_GEN_USER_ACTIVE_LIMIT:
+        await message.reply_text("⏳ Предыдущая генерация ещё не закончилась, дождись результата.")
+        return
+
+    # Слот задачи и квоту резервируем до первого await: обработчики работают параллельно,
+    # и иначе несколько быстрых /gen подряд прошли бы обе проверки одновременно
+    image_jobs_active[user_id] = image_jobs_active.get(user_id, 0) + 1
+    image_quota_reserved[user_id] = image_quota_reserved.get(user_id, 0) + variants
+    reserved = variants
+    started = False
+    try:
+        cache_key = image_cache_key(prompt, options["size"], options["quality"])
+        cached = await get_cached_images(cache_key)
+        missing = max(0, variants - len(cached))
+        # Картинки из кэша квоту не тратят — возвращаем их часть резерва
+        image_quota_reserved[user_id] -= reserved - missing
+        reserved = missing
+
+        quota_left = await image_quota_left(user_id) - image_quota_reserved[user_id]
+        if quota_left < 0:
+            await message.reply_text(
+                f"⛔ Лимит генераций исчерпан: осталось {max(0, quota_left + missing)} из {IMAGE_GEN_QUOTA}. Попробуй позже."
+            )
+            return
+
+        status_message = await message.reply_text("🎨 Генерирую изображение...")
+        task = asyncio.create_task(run_image_job(status_message, prompt, options, cache_key, cached[:variants], missing, user_id))
+        started = True
+    finally:
+        # Задача не запустилась (отказ или ошибка) — резерв больше не нужен
+        if not started:
+            release_image_job(user_id, reserved)
+    image_jobs.add(task)
+    task.add_done_callback(image_jobs.discard)
+
+# Один вызов DALL·E в отдельном потоке, не больше IMAGE_GEN_CONCURRENCY одновременно
+async def generate_image(prompt: str, size: str, quality: str, progress: dict) -> dict:
+    async with image_gen_semaphore:
+        progress["queued"] -= 1
+        image = await run_model_call(
+            client_ai.images.generate,
+            model="dall-e-3",
+            prompt=prompt,
+            n=1, # dall-e-3 умеет только n=1, варианты запрашиваем параллельно
+            size=size,
+            quality=quality
+        )
+    progress["done"] += 1
+    return {"url": image.data[0].url, "revised_prompt": image.data[0].revised_prompt, "created_at": time.time()}
+
+# Периодически обновляет сообщение "Генерирую изображение..." до завершения задачи
+async def report_image_progress(status_message, progress: dict, total: int):
+    started_at = time.time()
+    while True:
+        await asyncio.sleep(IMAGE_GEN_PROGRESS_INTERVAL)
+        elapsed = int(time.time() - started_at)
+        if progress["queued"] == total:
+            text = f"🎨 Генерирую изображение... в очереди ({elapsed} с)"
+        else:
+            text = f"🎨 Генерирую изображение... {elapsed} с"
+        if total > 1:
+            text += f"\nГотово вариантов: {progress['done']}/{total}"
+        try:
+            await status_message.edit_text(text)
+        except Exception:
+            pass # Не мешаем генерации из-за ошибки обновления статуса
+
+async def run_image_job(status_message, prompt: str, options: dict, cache_key: str, cached: list, missing: int, user_id):
+    progress = {"queued": missing, "done": 0}
+    progress_task = asyncio.create_task(report_image_progress(status_message, progress, missing))
+    try:
+        results = await asyncio.gather(
+            *[generate_image(prompt, options["size"], options["quality"], progress) for _ in range(missing)],
+            return_exceptions=True
+        )
+        generated = [r for r in results if not isinstance(r, Exception)]
+        errors = [r for r in results if isinstance(r, Exception)]
+        if generated:
+            await consume_image_quota(user_id, len(generated))
+            await add_cached_images(cache_key, generated)
+        images = cached + generated
+    finally:
+        progress_task.cancel()
+        # Списаны только реально сгенерированные картинки, резерв за неудачные варианты возвращается
+        release_image_job(user_id, missing)
+
+    if not images:
+        await status_message.edit_text(f"❌ Ошибка генерации: {errors[0]}")
+        return
+
+    if len(images) == 1:
+        links = f"<a href='{images[0]['url']}'>🔗 Открыть картинку</a>"
+    else:
+        links = "\n".join(f"<a href='{img['url']}'>🔗 Вариант {i}</a>" for i, img in enumerate(images, 1))
+    text = (
+        f"🖼 <b>Готово!</b>\n"
+        f"prompt: <code>{images[0]['revised_prompt']}</code>\n\n"
+        f"{links}"
+    )
+    if errors:
+        text += f"\n\n⚠️ Не удалось сгенерировать вариантов: {len(errors)} ({errors[0]})"
+    await status_message.edit_text(
+        text,
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=False  # Показываем превью картинки
+    )
+
 # Адаптируем существующие хендлеры, чтобы они вызывали process_message
 
-@client.on_message(filters.text & ~filters.command(["start", "forget", "context", "model", "gen", "info", "help"]))
+@client.on_message(filters.text & ~filters.command(["start", "forget", "context", "model", "gen", "info", "help", "retention", "stats"]))
 async def chat_handler(_, message: Message):
     chat_id = message.chat.id
-    state = user_states.get(chat_id)
+    state = await user_states.get(chat_id)
 
     if state == "awaiting_context":
         db = next(get_db())
@@ -606,35 +1545,14 @@ async def chat_handler(_, message: Message):
                 await message.reply_text("❗ Сначала напиши /start.")
         finally:
             db.close()
-        user_states.pop(chat_id)
+        await user_states.pop(chat_id)
         return
 
     elif state == "awaiting_prompt":
-        prompt = message.text
-        imamess = await message.reply_text("🎨 Генерирую изображение...")
-
-        try:
-            image = client_ai.images.generate(
-                model="dall-e-3",
-                prompt=prompt,
-                n=1,
-                size="1024x1024",
-                quality="standard"
-            )
-            url = image.data[0].url
-
-            await imamess.edit_text(
-                f"🖼 <b>Готово!</b>\n"
-                f"prompt: <code>{image.data[0].revised_prompt}</code>\n\n"
-                f"<a href='{url}'>🔗 Открыть картинку</a>",
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=False  # Показываем превью картинки
-            )
-
-        except Exception as e:
-            await imamess.edit_text(f"❌ Ошибка генерации: {e}")
-
-        user_states.pop(chat_id)
+        await user_states.pop(chat_id)
+        options = await gen_options.pop(chat_id) or parse_gen_options([])
+        # Генерация идёт фоновой задачей, обработчик сразу освобождается
+        await start_image_job(message, message.text, options)
         return
 
     # Обычный текст — к GPT
@@ -718,7 +1636,16 @@ async def handle_base64_image(_, message: Message):
 
 @client.on_message(filters.command("gen"))
 async def ask_prompt(_, message: Message):
-    user_states[message.chat.id] = "awaiting_prompt"
+    # /gen [кол-во вариантов] [hd] [размер] [промпт]
+    args = message.command[1:]
+    options = parse_gen_options(args)
+    prompt = " ".join(args[options.pop("consumed"):])
+    if prompt:
+        await start_image_job(message, prompt, options)
+        return
+
+    await user_states.set(message.chat.id, "awaiting_prompt")
+    await gen_options.set(message.chat.id, options)
 
     cancel_button = InlineKeyboardMarkup([
         [InlineKeyboardButton("❌ Отменить", callback_data="cancel_gen")]
@@ -729,13 +1656,14 @@ async def ask_prompt(_, message: Message):
 @client.on_callback_query(filters.regex("cancel_context"))
 async def cancel_context(_, query):
     chat_id = query.message.chat.id
-    user_states.pop(chat_id, None)
+    await user_states.pop(chat_id)
     await query.message.delete()
 
 @client.on_callback_query(filters.regex("cancel_gen"))
 async def cancel_gen(_, query):
     chat_id = query.message.chat.id
-    user_states.pop(chat_id, None)
+    await user_states.pop(chat_id)
+    await gen_options.pop(chat_id)
     await query.message.delete()
 
 
@@ -763,6 +1691,31 @@ async def info(_, message: Message):
     finally:
         db.close()
 
+# Команда /stats — эффект кэширования промпта по моделям
+@client.on_message(filters.command("stats"))
+async def stats(_, message: Message):
+    db = next(get_db())
+    try:
+        rows = db.execute(select(ModelUsage).order_by(ModelUsage.requests.desc())).scalars().all()
+        if not rows:
+            await message.reply_text("📈 Статистики пока нет.")
+            return
+
+        lines = ["📈 <b>Кэширование промпта по моделям</b>\n"]
+        for row in rows:
+            hit_rate = row.cached_tokens / row.prompt_tokens * 100 if row.prompt_tokens else 0
+            uncached_requests = row.requests - row.cached_requests
+            cached_latency = f"{row.cached_latency_total / row.cached_requests:.1f} с" if row.cached_requests else "—"
+            uncached_latency = f"{(row.latency_total - row.cached_latency_total) / uncached_requests:.1f} с" if uncached_requests else "—"
+            lines.append(
+                f"<code>{row.model_name}</code>: {row.requests} запр., "
+                f"из кэша {hit_rate:.0f}% токенов промпта ({row.cached_tokens}/{row.prompt_tokens})\n"
+                f"⏱ с кэшем {cached_latency}, без кэша {uncached_latency}"
+            )
+        await message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    finally:
+        db.close()
+
 @client.on_message(filters.command("help"))
 async def help_command(_, message: Message):
     help_text = (
@@ -780,17 +1733,25 @@ async def help_command(_, message: Message):
         "➤ Удаляет контекст предыдущих сообщений\n"
         "📝 Пример: <code>/forget</code>\n\n"
 
+        "🗄 <b>/retention</b> — Сколько истории хранить\n"
+        "➤ Ограничение по возрасту (дни), числу ходов и объёму; 0 — без ограничения\n"
+        "📝 Пример: <code>/retention days=30 turns=200</code>\n\n"
+
         "🤖 <b>/model</b> — Выбор модели GPT\n"
         "➤ Нажми на кнопку с нужной моделью\n"
         "📝 Пример: <code>/model</code>\n\n"
 
         "🎨 <b>/gen</b> — Генерация изображения по описанию\n"
         "➤ Введи команду, затем отправь описание картинки\n"
-        "📝 Пример:\n<code>/gen</code>\n<code>кошка на подоконнике</code>\n\n"
+        "📝 Пример:\n<code>/gen</code>\n<code>кошка на подоконнике</code>\n"
+        f"➤ Можно сразу указать число вариантов (1–{IMAGE_GEN_MAX_VARIANTS}), качество и размер: <code>/gen 3 hd 1792x1024 кошка на подоконнике</code>\n\n"
 
         "ℹ️ <b>/info</b> — Показать текущую модель и системный промпт\n"
         "📝 Пример: <code>/info</code>\n\n"
 
+        "📈 <b>/stats</b> — Доля промпта из кэша провайдера и время ответа по моделям\n"
+        "📝 Пример: <code>/stats</code>\n\n"
+
         "🆘 <b>/help</b> — Это справочное меню\n"
         "📝 Пример: <code>/help</code>\n\n"
 
@@ -802,6 +1763,94 @@ async def help_command(_, message: Message):
 
 
 
+# Супервизор: запускает BOT_WORKERS процессов-воркеров, следит за их здоровьем и перезапускает упавших
+def run_supervisor(worker_count: int):
+    if STATE_BACKEND != "sqlite":
+        raise ValueError("Для нескольких воркеров нужно общее хранилище состояний: STATE_BACKEND=sqlite")
+
+    workers = {} # {worker_id: {'process': Popen | None, 'started_at': float, 'failures': int, 'restart_at': float}}
+    stopping = False
+
+    def spawn(worker_id: int):
+        env = dict(os.environ, WORKER_ID=str(worker_id), WORKER_COUNT=str(worker_count))
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        workers[worker_id].update(process=process, started_at=time.time())
+        print(f"🚀 Воркер {worker_id} запущен (pid {process.pid})")
+
+    def is_healthy(worker_id: int, process) -> bool:
+        # Даём воркеру время на подключение к Telegram, прежде чем требовать heartbeat
+        if time.time() - workers[worker_id]['started_at'] < WORKER_HEALTH_TIMEOUT:
+            return True
+        heartbeat = state_store.get("workers", str(worker_id))
+        return bool(heartbeat) and heartbeat["pid"] == process.pid and time.time() - heartbeat["ts"] < WORKER_HEALTH_TIMEOUT
+
+    def schedule_restart(worker_id: int):
+        worker = workers[worker_id]
+        # Если воркер успел проработать дольше таймаута, считаем падение случайным и сбрасываем счётчик
+        if time.time() - worker['started_at'] > WORKER_HEALTH_TIMEOUT:
+            worker['failures'] = 0
+        worker['failures'] += 1
+        delay = min(2 ** (worker['failures'] - 1), WORKER_RESTART_MAX_DELAY)
+        worker.update(process=None, restart_at=time.time() + delay)
+        print(f"🔁 Воркер {worker_id} будет перезапущен через {delay} с")
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker_id in range(worker_count):
+        workers[worker_id] = {'process': None, 'started_at': 0.0, 'failures': 0, 'restart_at': 0.0}
+        spawn(worker_id)
+    print(f"🤖 GPT Telegram бот запущен в режиме супервизора ({worker_count} воркеров)...")
+
+    while not stopping:
+        time.sleep(1)
+        for worker_id, worker in workers.items():
+            process = worker['process']
+            if process is None:
+                if time.time() >= worker['restart_at']:
+                    spawn(worker_id)
+            elif process.poll() is not None:
+                print(f"❌ Воркер {worker_id} завершился с кодом {process.returncode}")
+                schedule_restart(worker_id)
+            elif not is_healthy(worker_id, process):
+                print(f"❌ Воркер {worker_id} не отвечает, перезапускаю")
+                process.kill()
+                process.wait()
+                schedule_restart(worker_id)
+
+    # Останавливаем воркеров: сначала вежливо, затем принудительно
+    for worker in workers.values():
+        if worker['process'] and worker['process'].poll() is None:
+            worker['process'].terminate()
+    for worker in workers.values():
+        if worker['process']:
+            try:
+                worker['process'].wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker['process'].kill()
+
+
 # Запуск бота
-print("🤖 GPT Telegram бот запущен...")
-client.run()
\ No newline at end of file
+async def main():
+    await client.start()
+    # Подхватываем медиа-группы, не обработанные до перезапуска
+    await media_group_assembler.resume(client)
+    background_tasks = [asyncio.create_task(purge_expired_states()), asyncio.create_task(database_maintenance())]
+    if WORKER_COUNT > 1:
+        background_tasks.append(asyncio.create_task(worker_heartbeat()))
+        print(f"🤖 Воркер {WORKER_ID}/{WORKER_COUNT} запущен...")
+    else:
+        print("🤖 GPT Telegram бот запущен...")
+    await idle()
+    for task in background_tasks:
+        task.cancel()
+    await client.stop()
+
+if BOT_WORKERS > 1 and "WORKER_ID" not in os.environ:
+    run_supervisor(BOT_WORKERS)
+else:
+    client.run(main())
\ No newline at end of file